@@ -1,17 +1,68 @@
 from fastapi import FastAPI, Request, Response, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse, PlainTextResponse
+from fastapi.responses import StreamingResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
-from urllib.parse import urljoin, unquote
+from urllib.parse import urljoin, unquote, urlsplit, quote
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import json
+import gzip
 import logging
+import os
 import re
-import json
+import ssl
+import sys
 import asyncio
 
+# libuv event loop: a drop-in speedup for the asyncio socket/TLS work this
+# proxy spends most of its time in (uvicorn --loop uvloop also works)
+if sys.platform != "win32":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("proxy")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The client is created inside the running event loop (not at import),
+    # so the pool can never straddle loops under --workers/--reload or tests,
+    # and aclose() drains keepalive connections on shutdown.
+    # HTTP/2 so segment fetches multiplex over one CDN connection, explicit
+    # pool limits sized for a segment storm, and no proxy-env lookups per
+    # request.
+    # One SSLContext shared by the whole pool (verification stays off, as
+    # verify=False did): new connections reuse the context's TLS session
+    # tickets, so reconnects to a CDN resume instead of paying a full
+    # handshake. keepalive_expiry spans a playback session, not a request
+    # burst, and retries=1 absorbs a stale keepalive socket at connect.
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    app.state.client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            verify=ctx,
+            http2=True,
+            retries=1,
+            limits=httpx.Limits(max_connections=512, max_keepalive_connections=256, keepalive_expiry=300.0),
+        ),
+        follow_redirects=True,
+        trust_env=False,
+        headers=VIDEO_HEADERS,
+        # read is a between-bytes timeout, not whole-body: 30s unsticks a
+        # dead upstream without cutting long-running segment streams
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=5.0),
+    )
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -20,14 +71,281 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# streaming chunk size: big enough that the client's TCP window, not the
+# event loop, is the ceiling; tunable without a code change
+CHUNK_SIZE = int(os.getenv("PROXY_CHUNK_KB", "512")) * 1024
+
 VIDEO_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Linux; Android 10) AppleWebKit/537.36 "
                   "(KHTML, like Gecko) Chrome/137.0.0.0 Mobile Safari/537.36",
     "Referer": "https://www.animesaturn.cx/watch?file=xNIuYkLOOfAwo&server=0",
 }
 
-# single shared client
-client = httpx.AsyncClient(verify=False, timeout=None)
+# Rewritten-playlist cache: origin_url -> (expiry, body, etag, last_modified,
+# ttl). Media playlists only change once per target duration (the TTL is
+# derived from #EXT-X-TARGETDURATION when present), master playlists
+# basically never, so concurrent viewers of the same stream can share one
+# upstream GET. Once an entry expires we revalidate with If-None-Match /
+# If-Modified-Since: a 304 skips both the transfer and the rewrite.
+# Keyed by the full URL, so LL-HLS _HLS_msn/_HLS_part query params get
+# distinct entries automatically; LRU-bounded at PLAYLIST_CACHE_MAX entries.
+PLAYLIST_CACHE: OrderedDict[str, tuple[float, bytes, str, str, float]] = OrderedDict()
+PLAYLIST_CACHE_MAX = 512
+PLAYLIST_LOCKS: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+MEDIA_PLAYLIST_TTL = 2.0
+MASTER_PLAYLIST_TTL = 60.0
+
+def _playlist_cache_store(url, body, etag, last_modified, ttl):
+    PLAYLIST_CACHE[url] = (asyncio.get_running_loop().time() + ttl, body, etag, last_modified, ttl)
+    PLAYLIST_CACHE.move_to_end(url)
+    while len(PLAYLIST_CACHE) > PLAYLIST_CACHE_MAX:
+        PLAYLIST_CACHE.popitem(last=False)
+
+# Bound concurrent upstream fetches so one rogue client (ten <video> tabs,
+# a parallel Range scraper) can't drain the whole httpx pool and starve
+# everyone else. Segments get most of the budget, sized just under
+# max_connections; playlists draw from their own small slice so a playlist
+# storm never eats segment capacity.
+UPSTREAM_SEM = asyncio.Semaphore(400)
+PLAYLIST_SEM = asyncio.Semaphore(50)
+
+# Single-flight segment coalescing: TS/m4s segments are small and immutable,
+# so when N viewers of the same stream ask for the same (url, range) the
+# first fetch buffers the bytes while relaying them and everyone else is
+# served from that buffer. Entries are LRU-evicted past SEGMENT_CACHE_MAX
+# total; anything larger than SEGMENT_MAX_ITEM is never buffered.
+SEGMENT_INFLIGHT: dict[tuple, asyncio.Future] = {}
+SEGMENT_CACHE: OrderedDict[tuple, tuple] = OrderedDict()
+SEGMENT_CACHE_MAX = 64 * 1024 * 1024
+SEGMENT_MAX_ITEM = 8 * 1024 * 1024
+_segment_cache_bytes = 0
+
+def _segment_cache_get(key):
+    entry = SEGMENT_CACHE.get(key)
+    if entry is not None:
+        SEGMENT_CACHE.move_to_end(key)
+    return entry
+
+def _segment_inflight_drop(key, future):
+    # un-register a claimed fetch that won't produce a buffer; waiters get
+    # None and fall back to their own upstream fetch
+    SEGMENT_INFLIGHT.pop(key, None)
+    if not future.done():
+        future.set_result(None)
+
+def _segment_cache_put(key, entry):
+    global _segment_cache_bytes
+    if key in SEGMENT_CACHE:
+        return
+    SEGMENT_CACHE[key] = entry
+    _segment_cache_bytes += len(entry[2])
+    while _segment_cache_bytes > SEGMENT_CACHE_MAX:
+        _, old = SEGMENT_CACHE.popitem(last=False)
+        _segment_cache_bytes -= len(old[2])
+
+class SegmentRecorder:
+    """Buffers one upstream segment while it streams to the first viewer.
+
+    On a complete relay the buffer is published to SEGMENT_CACHE and the
+    in-flight future resolves with it; on disconnect, error or oversize the
+    future resolves with None and waiters fall back to their own fetch.
+    """
+
+    def __init__(self, key, future, status_code, headers):
+        self.key = key
+        self.future = future
+        self.status_code = status_code
+        self.headers = headers
+        self.buf = bytearray()
+        self.abandoned = False
+
+    def add(self, chunk):
+        if self.abandoned:
+            return
+        self.buf += chunk
+        if len(self.buf) > SEGMENT_MAX_ITEM:
+            self._abandon()
+
+    def finish(self, complete):
+        if self.abandoned:
+            return
+        if not complete:
+            self._abandon()
+            return
+        entry = (self.status_code, self.headers, bytes(self.buf))
+        _segment_cache_put(self.key, entry)
+        self._resolve(entry)
+
+    def _abandon(self):
+        self.abandoned = True
+        self.buf = bytearray()
+        self._resolve(None)
+
+    def _resolve(self, result):
+        SEGMENT_INFLIGHT.pop(self.key, None)
+        if not self.future.done():
+            self.future.set_result(result)
+
+# Range alignment: browsers ask for arbitrary offsets (bytes=1234567-),
+# which gives every viewer a distinct CDN cache key. Snapping the upstream
+# range to 1 MiB boundaries and trimming locally collapses those to a small
+# set of cacheable chunk requests.
+RANGE_ALIGN = 1024 * 1024
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)$")
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# One pass over the raw playlist bytes: group 1 is a bare URI line (any
+# non-comment, non-blank line), group 2 a URI="..." attribute on a tag line
+# (audio/subs/keys). Alternation keeps it a single C-level scan.
+# ($ won't match before a bare \r, so CRLF endings are captured explicitly)
+PLAYLIST_URI_RE = re.compile(rb'(?m)^(?![#\r\n])([^\r\n]+?)(\r?)$|URI="([^"]+)"')
+TARGET_DURATION_RE = re.compile(rb"#EXT-X-TARGETDURATION:([0-9.]+)")
+
+# Live playlists repeat most segment URIs across successive refreshes, so
+# the resolve+quote result is memoized; 64k entries outlive any realistic
+# sliding window of live segments across concurrent streams.
+@lru_cache(maxsize=65536)
+def _resolve_proxy_uri(uri, origin_base, scheme_host, _quote=quote):
+    if uri.startswith(("http://", "https://")):
+        # already absolute: take it as-is, no URL parse needed
+        abs_uri = uri
+    elif uri.startswith("//") or "../" in uri:
+        # protocol-relative / dot-segments go through the full resolver
+        abs_uri = urljoin(origin_base, uri)
+    elif uri.startswith("/"):
+        # root-relative: scheme+host were computed once for the playlist
+        abs_uri = scheme_host + uri
+    elif uri.startswith("./"):
+        abs_uri = origin_base + uri[2:]
+    else:
+        # sibling-relative (the common CDN case): plain concat, no URL parse
+        abs_uri = origin_base + uri
+    # percent-encode so '&'/'?'/'#' in signed CDN tokens survive the trip
+    # through our own query string
+    return "/proxy?url=" + _quote(abs_uri, safe="")
+
+def _rewrite_playlist(body: bytes, origin_base: str, scheme_host: str):
+    """Rewrite every URI in an m3u8 body to route through /proxy.
+
+    Pure CPU over the whole body, so it runs in a worker thread (see the
+    call site): a large DVR manifest takes tens of milliseconds here and
+    must not stall concurrent segment streams. The whole rewrite is one
+    compiled-regex substitution over the raw bytes — no per-line Python
+    loop and no decode/re-encode of the 99% of the body that is left
+    untouched; only matched URI tokens round-trip through str. Returns the
+    rewritten bytes plus what the cache TTL heuristics need (master flag,
+    target duration).
+    """
+    def repl(m):
+        seg, cr, attr = m.group(1, 2, 3)
+        if seg is not None:
+            return _resolve_proxy_uri(seg.decode(), origin_base, scheme_host).encode() + cr
+        return b'URI="' + _resolve_proxy_uri(attr.decode(), origin_base, scheme_host).encode() + b'"'
+
+    is_master = b"#EXT-X-STREAM-INF" in body
+    target_duration = None
+    m = TARGET_DURATION_RE.search(body)
+    if m:
+        try:
+            target_duration = float(m.group(1))
+        except ValueError:
+            pass
+    return PLAYLIST_URI_RE.sub(repl, body), is_master, target_duration
+
+class RawStreamResponse(Response):
+    """Bare ASGI pass-through for proxied media bytes.
+
+    Skips StreamingResponse's per-chunk type checks and string encoding:
+    upstream chunks go straight to `await send()`. The upstream response
+    is closed when the client goes away or the body ends.
+    """
+
+    def __init__(self, upstream, status_code: int, headers: dict, skip: int = 0, limit: int = None,
+                 semaphore: asyncio.Semaphore = None, recorder: "SegmentRecorder" = None):
+        self.upstream = upstream
+        self.semaphore = semaphore
+        self.recorder = recorder
+        self.status_code = status_code
+        self.raw_headers = [
+            (k.lower().encode("latin-1"), v.encode("latin-1"))
+            for k, v in headers.items() if v
+        ]
+        # trim window for range-aligned upstream fetches: drop `skip` leading
+        # bytes, deliver at most `limit` bytes (None = to EOF)
+        self.skip = skip
+        self.limit = limit
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
+        # Bounded queue between the upstream reader and the client writer:
+        # a client write stall no longer backpressures the upstream socket
+        # immediately (and vice versa), so short jitter on either side is
+        # absorbed. maxsize * CHUNK_SIZE caps the buffer (~2 MiB default).
+        queue: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+        async def produce():
+            skip, remaining = self.skip, self.limit
+            complete = False
+            try:
+                try:
+                    # aiter_raw skips httpx's content-decoding path; TS/MP4
+                    # is never gzip-encoded so there is nothing to decode
+                    async for chunk in self.upstream.aiter_raw(CHUNK_SIZE):
+                        if self.recorder is not None:
+                            # record the untrimmed upstream bytes for others
+                            self.recorder.add(chunk)
+                        if remaining == 0:
+                            if self.recorder is None:
+                                break
+                            # client has its bytes; keep draining (bounded by
+                            # the aligned range) so the buffer is complete
+                            continue
+                        if skip:
+                            if len(chunk) <= skip:
+                                skip -= len(chunk)
+                                continue
+                            chunk = chunk[skip:]
+                            skip = 0
+                        if remaining is not None:
+                            if len(chunk) > remaining:
+                                chunk = chunk[:remaining]
+                            remaining -= len(chunk)
+                        if chunk:
+                            await queue.put(chunk)
+                    else:
+                        complete = True
+                except Exception as e:
+                    logger.exception("Upstream read error: %s", e)
+                await queue.put(None)
+            finally:
+                if self.recorder is not None:
+                    self.recorder.finish(complete)
+
+        producer = asyncio.create_task(produce())
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except Exception as e:
+            logger.exception("Streaming error: %s", e)
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+            await self.upstream.aclose()
+            if self.semaphore is not None:
+                self.semaphore.release()
+
 
 def make_cors_headers(extra: dict = None):
     base = {"Access-Control-Allow-Origin": "*"}
@@ -35,255 +353,461 @@ def make_cors_headers(extra: dict = None):
         base.update(extra)
     return base
 
+def _playlist_response(body: bytes, accepts_gzip: bool):
+    # rewritten playlists are highly compressible text (~5x), so gzip them
+    # to the client when allowed; video bytes are never compressed
+    headers = make_cors_headers({"Cache-Control": "no-cache", "Vary": "Accept-Encoding"})
+    if accepts_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(gzip.compress(body), media_type="application/vnd.apple.mpegurl",
+                        headers=headers)
+    return Response(body, media_type="application/vnd.apple.mpegurl", headers=headers)
+
+def _segment_response(entry, client_start, client_end, is_mpegts):
+    # serve a buffered segment, sliced down to the range this viewer asked for
+    status_code, up_headers, body = entry
+    content_type = "video/MP2T" if is_mpegts else (up_headers.get("content-type") or "video/mp4")
+    headers = make_cors_headers({
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-transform",
+    })
+    if status_code == 206 and client_start is not None:
+        cr = CONTENT_RANGE_RE.match(up_headers.get("content-range") or "")
+        if cr:
+            served_start, served_end, total = int(cr.group(1)), int(cr.group(2)), cr.group(3)
+            if client_start > served_end:
+                # same guard as the live trim path: a start past EOF would
+                # slice a negative width, so answer 416 instead
+                return Response(status_code=416,
+                                headers=make_cors_headers({"Content-Range": f"bytes */{total}"}))
+            end = served_end if client_end is None else min(client_end, served_end)
+            body = body[client_start - served_start:end - served_start + 1]
+            headers["Content-Range"] = f"bytes {client_start}-{end}/{total}"
+            return Response(body, status_code=206, media_type=content_type, headers=headers)
+    # unsliced replay (suffix/multipart ranges recorded verbatim): a 206
+    # still needs its Content-Range, so forward the recorded one
+    if status_code == 206 and up_headers.get("content-range"):
+        headers["Content-Range"] = up_headers["content-range"]
+    return Response(body, status_code=status_code, media_type=content_type, headers=headers)
+
 @app.get("/")
 async def root():
     return {"message": "Proxy server ready (HLS + MP4/TS)"}
 
 @app.get("/proxy")
 async def proxy_stream(request: Request):
+    client = request.app.state.client
     origin_url = request.query_params.get("url")
     if not origin_url:
-        return PlainTextResponse("Missing 'url' query parameter", status_code=400)
+        raise HTTPException(status_code=400, detail="Missing url")
 
-    # origin_url might be encoded; decode for checks and for making absolute URIs
-    origin_url = unquote(origin_url)
+    # origin_url might be encoded; decode for checks and for making absolute
+    # URIs — but only when there's an escape to decode, the membership test
+    # is a C-level scan vs. unquote's split/alloc
+    if "%" in origin_url:
+        origin_url = unquote(origin_url)
     logger.info("Requested /proxy -> %s", origin_url)
 
+    # Classify once on the lowercased path only: signed CDN query strings
+    # are long and case-sensitive, no point lowercasing them three times
+    url_parts = urlsplit(origin_url)
+    path_lower = url_parts.path.lower()
+
     # --- Bypass ONLY if the URL ends with /uwu.m3u8 (serve it raw, no rewriting) ---
-    if origin_url.endswith("/uwu.m3u8"):
+    if path_lower.endswith("/uwu.m3u8"):
         logger.info("Bypass: serving uwu.m3u8 raw via server for %s", origin_url)
+        # no rewriting here, so the body never needs decoding or buffering:
+        # forward the client's codec support upstream and relay the raw
+        # bytes (and their Content-Encoding) verbatim as they arrive
         try:
-            resp = await client.get(origin_url, headers=VIDEO_HEADERS)
+            resp = await client.send(
+                client.build_request("GET", origin_url, headers={
+                    "Accept-Encoding": request.headers.get("accept-encoding", "identity"),
+                }),
+                stream=True,
+            )
         except Exception as e:
             logger.exception("Error fetching uwu.m3u8: %s", e)
             raise HTTPException(status_code=502, detail="Upstream fetch failed")
 
-        return Response(
-            content=resp.content,
+        # status and headers come off the open response before any body
+        # bytes move, so DVR-sized manifests never sit in memory here
+        bypass_headers = make_cors_headers({"Cache-Control": "no-cache", "Vary": "Accept-Encoding"})
+        if resp.headers.get("content-encoding"):
+            bypass_headers["Content-Encoding"] = resp.headers["content-encoding"]
+
+        async def relay():
+            try:
+                async for chunk in resp.aiter_raw(65536):
+                    yield chunk
+            finally:
+                await resp.aclose()
+
+        return StreamingResponse(
+            relay(),
             status_code=resp.status_code,
             media_type=resp.headers.get("content-type", "application/vnd.apple.mpegurl"),
-            headers={**make_cors_headers({"Cache-Control": "no-cache"})}
+            headers=bypass_headers,
         )
 
-    is_m3u8 = origin_url.lower().endswith(".m3u8")
-    is_ts = origin_url.lower().endswith(".ts") or origin_url.lower().endswith(".m4s")
+    is_m3u8 = path_lower.endswith(".m3u8")
+    is_mpegts = path_lower.endswith(".ts")
+    is_ts = is_mpegts or path_lower.endswith(".m4s")
 
     # -------- Playlist handling (.m3u8) --------
     if is_m3u8:
-        logger.info("Fetching and rewriting playlist: %s", origin_url)
+        accepts_gzip = "gzip" in request.headers.get("accept-encoding", "")
+        now = asyncio.get_running_loop().time()
+        cached = PLAYLIST_CACHE.get(origin_url)
+        if cached and now < cached[0]:
+            PLAYLIST_CACHE.move_to_end(origin_url)
+            return _playlist_response(cached[1], accepts_gzip)
+
+        # Per-URL lock coalesces concurrent misses: the first caller fetches
+        # and rewrites, the rest wait and reuse its result from the cache.
+        lock = PLAYLIST_LOCKS[origin_url]
+        await lock.acquire()
         try:
-            resp = await client.get(origin_url, headers=VIDEO_HEADERS)
-        except Exception as e:
-            logger.exception("Error fetching playlist: %s", e)
-            raise HTTPException(status_code=502, detail="Upstream playlist fetch failed")
-
-        if resp.status_code >= 400:
-            logger.warning("Upstream playlist returned %s", resp.status_code)
-            return Response(resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type", "text/plain"),
-                            headers=make_cors_headers())
-
-        body = resp.text
-        origin_base = origin_url.rsplit("/", 1)[0] + "/"
-        new_lines = []
-        skip_next = False  # for #EXT-X-STREAM-INF lines
-
-        for line in body.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-
-            if line.startswith("#EXT-X-STREAM-INF"):
-                new_lines.append(line)
-                skip_next = True
-                continue
-
-            if skip_next:
-                # next line is variant URI
-                abs_uri = urljoin(origin_base, line)
-                line = f"/proxy?url={abs_uri}"
-                skip_next = False
-            elif not line.startswith("#") and not line.lower().startswith("http"):
-                # media segments or relative URIs
-                abs_uri = urljoin(origin_base, line)
-                line = f"/proxy?url={abs_uri}"
-            elif 'URI="' in line:
-                # audio/subs external URIs
-                match = re.search(r'URI="([^"]+)"', line)
-                if match:
-                    uri = match.group(1)
-                    abs_uri = urljoin(origin_base, uri)
-                    line = line.replace(uri, f"/proxy?url={abs_uri}")
-
-            new_lines.append(line)
-
-        content = "\n".join(new_lines)
-        return Response(content, media_type="application/vnd.apple.mpegurl",
-                        headers=make_cors_headers({"Cache-Control": "no-cache"}))
+            now = asyncio.get_running_loop().time()
+            cached = PLAYLIST_CACHE.get(origin_url)
+            if cached and now < cached[0]:
+                PLAYLIST_CACHE.move_to_end(origin_url)
+                return _playlist_response(cached[1], accepts_gzip)
+
+            logger.info("Fetching and rewriting playlist: %s", origin_url)
+            # identity: we rewrite the body anyway, so paying a gzip decode
+            # just to re-read it costs CPU for nothing; a stale cache entry
+            # turns this into a conditional GET. VIDEO_HEADERS are client
+            # defaults and get merged in by httpx — no copy here.
+            fetch_headers = {"Accept-Encoding": "identity"}
+            if cached:
+                if cached[2]:
+                    fetch_headers["If-None-Match"] = cached[2]
+                if cached[3]:
+                    fetch_headers["If-Modified-Since"] = cached[3]
+            await PLAYLIST_SEM.acquire()
+            try:
+                resp = await client.send(
+                    client.build_request("GET", origin_url, headers=fetch_headers),
+                    stream=True,
+                )
+            except Exception as e:
+                PLAYLIST_SEM.release()
+                logger.exception("Error fetching playlist: %s", e)
+                raise HTTPException(status_code=502, detail="Upstream playlist fetch failed")
+
+            if resp.status_code == 304 and cached:
+                # unchanged upstream: refresh the entry for another TTL and
+                # serve the previously rewritten bytes
+                await resp.aclose()
+                PLAYLIST_SEM.release()
+                _playlist_cache_store(origin_url, cached[1], cached[2], cached[3], cached[4])
+                return _playlist_response(cached[1], accepts_gzip)
+
+            # One close/release discipline for error and success bodies: a
+            # truncated or timed-out read must not leak the permit or the
+            # connection, and surfaces as 502 like every other upstream
+            # failure here.
+            try:
+                body = await resp.aread()
+            except Exception as e:
+                logger.exception("Error reading playlist body: %s", e)
+                raise HTTPException(status_code=502, detail="Upstream playlist read failed")
+            finally:
+                await resp.aclose()
+                PLAYLIST_SEM.release()
+
+            if resp.status_code >= 400:
+                logger.warning("Upstream playlist returned %s", resp.status_code)
+                return Response(body, status_code=resp.status_code, media_type=resp.headers.get("content-type", "text/plain"),
+                                headers=make_cors_headers())
+
+            etag = resp.headers.get("etag")
+            last_modified = resp.headers.get("last-modified")
+
+            origin_base = origin_url.rsplit("/", 1)[0] + "/"
+            scheme_host = f"{url_parts.scheme}://{url_parts.netloc}"
+            content, is_master, target_duration = await asyncio.to_thread(
+                _rewrite_playlist, body, origin_base, scheme_host)
+            if is_master:
+                ttl = MASTER_PLAYLIST_TTL
+            elif target_duration:
+                # media playlists can't change faster than half a segment
+                ttl = max(1.0, target_duration / 2)
+            else:
+                ttl = MEDIA_PLAYLIST_TTL
+            _playlist_cache_store(origin_url, content, etag, last_modified, ttl)
+        finally:
+            lock.release()
+
+        return _playlist_response(content, accepts_gzip)
 
     # -------- TS / fMP4 streaming --------
-    # Forward Range header if provided
-    headers = VIDEO_HEADERS.copy()
+    # Forward Range header if provided; VIDEO_HEADERS are client defaults
+    # and get merged in by httpx. identity keeps the CDN from gzipping
+    # already-compressed video, which aiter_raw would pass through encoded.
     range_header = request.headers.get("range")
+    req_headers = {"Accept-Encoding": "identity"}
+    client_start = client_end = None
     if range_header:
-        headers["Range"] = range_header
+        m = RANGE_RE.match(range_header)
+        if m:
+            # align the upstream range to RANGE_ALIGN boundaries and trim
+            # locally, so different viewer offsets share one CDN cache key
+            client_start = int(m.group(1))
+            client_end = int(m.group(2)) if m.group(2) else None
+            aligned_start = (client_start // RANGE_ALIGN) * RANGE_ALIGN
+            if client_end is not None:
+                aligned_end = (client_end // RANGE_ALIGN + 1) * RANGE_ALIGN - 1
+                req_headers["Range"] = f"bytes={aligned_start}-{aligned_end}"
+            else:
+                req_headers["Range"] = f"bytes={aligned_start}-"
+        else:
+            # suffix/multipart ranges: pass through untouched
+            req_headers["Range"] = range_header
 
     logger.info("Streaming request -> %s (Range: %s)", origin_url, range_header)
 
-    # We'll prefetch minimal HEAD to obtain status & relevant headers, then stream in generator
+    # Single-flight: identical segment requests (same url + aligned range)
+    # share the first fetch's buffer instead of multiplying origin traffic.
+    segment_key = None
+    if is_ts:
+        segment_key = (origin_url, req_headers.get("Range"))
+        entry = _segment_cache_get(segment_key)
+        if entry is None:
+            inflight = SEGMENT_INFLIGHT.get(segment_key)
+            if inflight is not None:
+                entry = await asyncio.shield(inflight)
+        if entry is not None:
+            return _segment_response(entry, client_start, client_end, is_mpegts)
+
+    # Claim the in-flight slot before opening the upstream: on a live-HLS
+    # tick every player asks for the new segment inside the same header
+    # round-trip, and registering only after headers land would let that
+    # whole stampede through. Waiters that get None fall back to their own
+    # fetch, so failures below just resolve the future empty.
+    future = None
+    if segment_key is not None and segment_key not in SEGMENT_INFLIGHT:
+        future = asyncio.get_running_loop().create_future()
+        SEGMENT_INFLIGHT[segment_key] = future
+
+    # Open the upstream stream once: status and headers come from the same
+    # response object the generator relays, so no extra HEAD/GET probe.
+    # The semaphore slot is held for the stream's lifetime and released by
+    # RawStreamResponse when the body (or the client) is done.
+    await UPSTREAM_SEM.acquire()
     try:
-        head_resp = await client.head(origin_url, headers=VIDEO_HEADERS)
-    except Exception:
-        head_resp = None
-
-    # If HEAD failed or not allowed, do a small GET to probe
-    if not head_resp or head_resp.status_code >= 400:
-        try:
-            probe = await client.get(origin_url, headers=VIDEO_HEADERS, timeout=10.0)
-            probe_status = probe.status_code
-            probe_headers = probe.headers
-        except Exception as e:
-            logger.exception("Error probing upstream for streaming: %s", e)
-            raise HTTPException(status_code=502, detail="Upstream stream probe failed")
-    else:
-        probe_status = head_resp.status_code
-        probe_headers = head_resp.headers
-
-    content_type = "video/MP2T" if origin_url.lower().endswith(".ts") else probe_headers.get("content-type", "video/mp4")
+        upstream_req = client.build_request("GET", origin_url, headers=req_headers)
+        resp = await client.send(upstream_req, stream=True)
+    except Exception as e:
+        UPSTREAM_SEM.release()
+        if future is not None:
+            _segment_inflight_drop(segment_key, future)
+        logger.exception("Error opening upstream stream: %s", e)
+        raise HTTPException(status_code=502, detail="Upstream stream open failed")
+
+    recorder = None
+    if future is not None:
+        if (resp.status_code in (200, 206)
+                and int(resp.headers.get("content-length", 0)) <= SEGMENT_MAX_ITEM):
+            recorder = SegmentRecorder(segment_key, future, resp.status_code, {
+                "content-type": resp.headers.get("content-type"),
+                "content-range": resp.headers.get("content-range"),
+                "content-length": resp.headers.get("content-length"),
+            })
+        else:
+            # bad status or oversize: not recordable, release the waiters
+            _segment_inflight_drop(segment_key, future)
+
+    logger.info("Upstream stream opened, status=%s", resp.status_code)
+
+    content_type = "video/MP2T" if is_mpegts else resp.headers.get("content-type", "video/mp4")
     response_headers = {
         "Content-Type": content_type,
-        "Content-Length": probe_headers.get("content-length"),
-        "Content-Range": probe_headers.get("content-range"),
-        "Accept-Ranges": probe_headers.get("accept-ranges", "bytes"),
+        "Accept-Ranges": resp.headers.get("accept-ranges", "bytes"),
+        # keep reverse proxies (nginx/Caddy) from buffering or recompressing
+        # the stream; chunks must reach the player as they arrive
+        "X-Accel-Buffering": "no",
+        "Cache-Control": "no-transform",
+        "Connection": "keep-alive",
     }
+    # Length/range headers are only valid if they describe the exact bytes
+    # we relay: forward them on 206, and on 200 only when upstream declared
+    # a length (a chunked upstream has none, and advertising a stale one
+    # makes browsers truncate the stream).
+    skip = 0
+    limit = None
+    if resp.status_code == 206:
+        if client_start is not None:
+            # upstream served the aligned range; answer the client with the
+            # range it actually asked for and trim the overshoot locally
+            cr = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+            if cr:
+                served_end = int(cr.group(2))
+                total = cr.group(3)
+                if client_start > served_end:
+                    # client start lies past EOF even though its aligned
+                    # start was inside the file (bytes=<filesize>- probes on
+                    # non-MiB-aligned files): the trim window would invert
+                    # into a negative Content-Length, so answer 416
+                    await resp.aclose()
+                    UPSTREAM_SEM.release()
+                    if recorder is not None:
+                        recorder.finish(False)
+                    return Response(status_code=416,
+                                    headers=make_cors_headers({"Content-Range": f"bytes */{total}"}))
+                end = served_end if client_end is None else min(client_end, served_end)
+                skip = client_start - int(cr.group(1))
+                limit = end - client_start + 1
+                response_headers["Content-Range"] = f"bytes {client_start}-{end}/{total}"
+                response_headers["Content-Length"] = str(limit)
+        else:
+            response_headers["Content-Length"] = resp.headers.get("content-length")
+            response_headers["Content-Range"] = resp.headers.get("content-range")
+    elif resp.status_code == 200:
+        response_headers["Content-Length"] = resp.headers.get("content-length")
     # ensure CORS on streaming responses
     response_headers.update(make_cors_headers())
 
-    async def stream_video():
-        # Single streaming connection which the generator keeps open while yielding
-        try:
-            async with client.stream("GET", origin_url, headers=headers) as resp:
-                logger.info("Upstream stream opened, status=%s", resp.status_code)
-                # yield raw chunks to client
-                async for chunk in resp.aiter_bytes(128 * 1024):
-                    if chunk:
-                        yield chunk
-        except Exception as e:
-            logger.exception("Streaming error: %s", e)
-            # try to surface an error to client by terminating generator
-            return
-
-    return StreamingResponse(
-        stream_video(),
-        status_code=probe_status or 200,
-        headers={k: v for k, v in response_headers.items() if v},
-        media_type=content_type,
-    )
+    return RawStreamResponse(resp, resp.status_code or 200, response_headers, skip=skip, limit=limit,
+                             semaphore=UPSTREAM_SEM, recorder=recorder)
 
 # ---------------- Embed Player ----------------
+# Compiled once at import: every request only substitutes the URL instead of
+# re-evaluating a ~3 KB f-string
+# The page is static except for the URL literal; one str.replace on a
+# plain-string template beats re-running Template substitution per hit
+EMBED_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>Embed Player</title>
+    <style>
+        body { margin: 0; background: #000; display:flex; justify-content:center; align-items:center; height:100vh; overflow:hidden; }
+        video { width:100%; height:100%; background:black; }
+        select { position:absolute; top:10px; right:10px; background:rgba(0,0,0,0.6); color:white; border:none; padding:6px 10px; border-radius:6px; font-size:14px; z-index:9999; }
+    </style>
+</head>
+<body>
+    <video id="video" controls autoplay playsinline></video>
+
+    <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
+    <script>
+        const video = document.getElementById('video');
+        const urlParam = __VIDEO_URL__;
+        const isHls = urlParam.toLowerCase().endsWith('.m3u8');
+        const source = "/proxy?url=" + encodeURIComponent(urlParam);
+
+        console.info("embed: urlParam=", urlParam, "isHls=", isHls, "source=", source);
+
+        if (isHls) {
+            if (Hls.isSupported()) {
+                const hls = new Hls({ autoStartLoad: true });
+                hls.on(Hls.Events.ERROR, function(event, data) {
+                    console.error('HLS error', event, data);
+                });
+                hls.loadSource(source);
+                hls.attachMedia(video);
+
+                hls.on(Hls.Events.MANIFEST_PARSED, (_, data) => {
+                    const levels = data.levels;
+                    if (levels && levels.length > 1) {
+                        const selector = document.createElement('select');
+                        const autoOpt = document.createElement('option');
+                        autoOpt.value = -1;
+                        autoOpt.textContent = 'Auto';
+                        selector.appendChild(autoOpt);
+
+                        levels.forEach((lvl, i) => {
+                            const opt = document.createElement('option');
+                            opt.value = i;
+                            opt.textContent = (lvl.height || lvl.bitrate) + 'p';
+                            selector.appendChild(opt);
+                        });
+
+                        selector.addEventListener('change', (e) => {
+                            const level = parseInt(e.target.value);
+                            hls.currentLevel = level;
+                        });
+                        document.body.appendChild(selector);
+                    }
+                    video.play().catch(e => console.warn('play prevented', e));
+                });
+            } else if (video.canPlayType('application/vnd.apple.mpegurl')) {
+                video.src = source;
+                video.addEventListener('loadedmetadata', () => video.play());
+            } else {
+                document.body.innerHTML = "<h3 style='color:white'>Browser cannot play HLS streams.</h3>";
+            }
+        } else {
+            video.src = source;
+            video.play();
+        }
+
+        video.addEventListener('ended', () => {
+            window.parent.postMessage({ type: 'saturn-video-ended' }, '*');
+        });
+
+        let lastSent = 0;
+        video.addEventListener('timeupdate', () => {
+            const t = Math.floor(video.currentTime);
+            if (t % 5 === 0 && t !== lastSent) {
+                lastSent = t;
+                window.parent.postMessage(
+                    {
+                        type: 'saturn-progress',
+                        currentTime: video.currentTime,
+                        duration: video.duration
+                    },
+                    '*'
+                );
+            }
+        });
+
+        window.addEventListener('message', (e) => {
+            if (e.data?.type === 'resume-video' && e.data?.time) {
+                video.currentTime = e.data.time;
+            }
+        });
+    </script>
+</body>
+</html>
+"""
+# pre-encoded so each hit is one bytes.replace and Starlette never has to
+# UTF-8-encode the body (Content-Length comes straight off the bytes)
+EMBED_TEMPLATE_BYTES = EMBED_TEMPLATE.encode("utf-8")
+
 @app.get("/embed", response_class=HTMLResponse)
 async def embed(request: Request):
     video_url = request.query_params.get("url", "")
     if not video_url:
         return HTMLResponse("<h3>Error: Missing ?url= parameter</h3>", status_code=400)
 
-    # safe JSON encode the URL for insertion into JS
-    video_url_js = json.dumps(video_url)
-
-    html_content = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <title>Embed Player</title>
-        <style>
-            body {{ margin: 0; background: #000; display:flex; justify-content:center; align-items:center; height:100vh; overflow:hidden; }}
-            video {{ width:100%; height:100%; background:black; }}
-            select {{ position:absolute; top:10px; right:10px; background:rgba(0,0,0,0.6); color:white; border:none; padding:6px 10px; border-radius:6px; font-size:14px; z-index:9999; }}
-        </style>
-    </head>
-    <body>
-        <video id="video" controls autoplay playsinline></video>
-
-        <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
-        <script>
-            const video = document.getElementById('video');
-            const urlParam = {video_url_js};
-            const isHls = urlParam.toLowerCase().endsWith('.m3u8');
-            const source = "/proxy?url=" + encodeURIComponent(urlParam);
-
-            console.info("embed: urlParam=", urlParam, "isHls=", isHls, "source=", source);
-
-            if (isHls) {{
-                if (Hls.isSupported()) {{
-                    const hls = new Hls({{ autoStartLoad: true }});
-                    hls.on(Hls.Events.ERROR, function(event, data) {{
-                        console.error('HLS error', event, data);
-                    }});
-                    hls.loadSource(source);
-                    hls.attachMedia(video);
-
-                    hls.on(Hls.Events.MANIFEST_PARSED, (_, data) => {{
-                        const levels = data.levels;
-                        if (levels && levels.length > 1) {{
-                            const selector = document.createElement('select');
-                            const autoOpt = document.createElement('option');
-                            autoOpt.value = -1;
-                            autoOpt.textContent = 'Auto';
-                            selector.appendChild(autoOpt);
-
-                            levels.forEach((lvl, i) => {{
-                                const opt = document.createElement('option');
-                                opt.value = i;
-                                opt.textContent = (lvl.height || lvl.bitrate) + 'p';
-                                selector.appendChild(opt);
-                            }});
-
-                            selector.addEventListener('change', (e) => {{
-                                const level = parseInt(e.target.value);
-                                hls.currentLevel = level;
-                            }});
-                            document.body.appendChild(selector);
-                        }}
-                        video.play().catch(e => console.warn('play prevented', e));
-                    }});
-                }} else if (video.canPlayType('application/vnd.apple.mpegurl')) {{
-                    video.src = source;
-                    video.addEventListener('loadedmetadata', () => video.play());
-                }} else {{
-                    document.body.innerHTML = "<h3 style='color:white'>Browser cannot play HLS streams.</h3>";
-                }}
-            }} else {{
-                video.src = source;
-                video.play();
-            }}
-
-            video.addEventListener('ended', () => {{
-                window.parent.postMessage({{ type: 'saturn-video-ended' }}, '*');
-            }});
-
-            let lastSent = 0;
-            video.addEventListener('timeupdate', () => {{
-                const t = Math.floor(video.currentTime);
-                if (t % 5 === 0 && t !== lastSent) {{
-                    lastSent = t;
-                    window.parent.postMessage(
-                        {{
-                            type: 'saturn-progress',
-                            currentTime: video.currentTime,
-                            duration: video.duration
-                        }},
-                        '*'
-                    );
-                }}
-            }});
-
-            window.addEventListener('message', (e) => {{
-                if (e.data?.type === 'resume-video' && e.data?.time) {{
-                    video.currentTime = e.data.time;
-                }}
-            }});
-        </script>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
\ No newline at end of file
+    # Percent-encode to a short ASCII-only literal: quote() leaves no '"',
+    # '<', backslash or newline behind, so it cannot break out of the JS
+    # string (script blocks are raw text, so no HTML-entity pass needed);
+    # json.dumps supplies the surrounding quotes
+    safe_url = quote(video_url, safe=":/?=&%#")
+    return Response(
+        content=EMBED_TEMPLATE_BYTES.replace(b"__VIDEO_URL__", json.dumps(safe_url).encode()),
+        media_type="text/html; charset=utf-8",
+        # the page is a pure function of ?url=, so let the browser cache
+        # re-renders (VOD players reload the embed on seek/episode change)
+        headers={"Cache-Control": "public, max-age=300"},
+    )
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # The proxy is network-bound: uvloop cuts per-socket-event overhead
+    # (installed above) and httptools replaces uvicorn's Python-level HTTP
+    # parser. Equivalent CLI: uvicorn main:app --loop uvloop --http httptools
+    # --workers <cores> for multi-core deployments.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+    )